@@ -1,17 +1,48 @@
 # fabric_utils.py
 
 import pandas as pd
+import pyarrow as pa
 from pyspark.sql import SparkSession
+from pyspark.sql.pandas.types import from_arrow_schema
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson # Optional: much faster JSON encoding for the nested Power BI payloads
+except ImportError:
+    orjson = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson else None
+_COMPLEX_TYPES = (list, dict)
+
+def clean_column_name(name) -> str:
+    """Standardizes a column name for Fabric tables ('.' and ' ' become '_')."""
+    return str(name).replace('.', '_').replace(' ', '_')
+
+def clean_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Standardizes DataFrame column names, leaving the column index untouched when nothing needs renaming."""
+    new_columns = [clean_column_name(col) for col in df.columns]
+    if new_columns != list(df.columns):
+        df.columns = new_columns
+    return df
+
 def _serialize_object(obj):
     """A simple helper to serialize complex Python objects to a string."""
+    obj_type = type(obj)
+    if obj_type is str:
+        return obj # Fast path: most cells are plain strings, and an identity check skips the MRO walk
     if obj is None:
         return None
-    if isinstance(obj, (list, dict)):
+    if obj_type is list or obj_type is dict or isinstance(obj, _COMPLEX_TYPES):
+        if orjson is not None:
+            try:
+                # orjson output is already compact
+                return orjson.dumps(obj, option=_ORJSON_OPTIONS).decode('utf-8')
+            except TypeError:
+                pass # e.g. integers wider than 64 bits; let the stdlib encoder try
         try:
             # Use a compact JSON representation
             return json.dumps(obj, separators=(',', ':'))
@@ -19,80 +50,161 @@ def _serialize_object(obj):
             return str(obj) # Fallback for non-serializable content
     return str(obj)
 
+def _serialize_object_column(series: pd.Series) -> pd.Series:
+    """
+    Serializes an object column to strings: list/dict cells become JSON, other non-null
+    cells are stringified and nulls are kept as nulls.
+    """
+    is_complex = series.map(lambda x: isinstance(x, _COMPLEX_TYPES), na_action='ignore').fillna(False).astype(bool)
+    is_scalar = series.notna() & ~is_complex
+    serialized = series.astype(object)
+    if is_complex.any():
+        serialized[is_complex] = series[is_complex].map(_serialize_object)
+    if is_scalar.any():
+        serialized[is_scalar] = series[is_scalar].astype(str)
+    return serialized
+
 def cast_dataframe_to_fabric_compatible_types(df: pd.DataFrame) -> pd.DataFrame:
     """
     Efficiently casts Pandas DataFrame columns to types compatible with Fabric Warehouse.
+    The DataFrame is modified in place (columns are replaced, not copied up front) and returned.
     """
     if df.empty:
         return df
 
     logging.info("Casting DataFrame to Fabric compatible types...")
-    df_copy = df.copy()
+
+    # Bucket columns by dtype kind in a single pass instead of one select_dtypes call per kind
+    # ('M' = datetime, tz-aware or naive; 'b' = bool; 'O' = object)
+    cols_by_kind = {'M': [], 'b': [], 'O': []}
+    for col, dtype in df.dtypes.items():
+        if dtype.kind in cols_by_kind:
+            cols_by_kind[dtype.kind].append(col)
 
     # --- Process Datetime Columns ---
-    dt_cols = df_copy.select_dtypes(include=['datetime64[ns]', 'datetimetz']).columns
-    if not dt_cols.empty:
-        logging.info(f"Processing datetime columns: {list(dt_cols)}")
+    dt_cols = cols_by_kind['M']
+    if dt_cols:
+        logging.info(f"Processing datetime columns: {dt_cols}")
         for col in dt_cols:
-            # Ensure datetime is timezone-naive, which is safer for many data warehouses
-            if df_copy[col].dt.tz is not None:
-                df_copy[col] = df_copy[col].dt.tz_localize(None)
-            df_copy[col] = pd.to_datetime(df_copy[col], errors='coerce')
+            # Ensure datetime is timezone-naive (in UTC), which is safer for many data warehouses.
+            # Kind 'M' columns are already datetimes, so no re-parse is needed.
+            series = df[col]
+            if getattr(series.dt, 'tz', None) is not None:
+                df[col] = series.dt.tz_convert('UTC').dt.tz_localize(None)
 
     # --- Process Boolean Columns ---
     # Spark handles nullable booleans well. Convert to pandas' dedicated nullable type.
-    bool_cols = df_copy.select_dtypes(include=['bool']).columns
-    if not bool_cols.empty:
-        logging.info(f"Processing boolean columns: {list(bool_cols)}")
+    bool_cols = cols_by_kind['b']
+    if bool_cols:
+        logging.info(f"Processing boolean columns: {bool_cols}")
         for col in bool_cols:
-            df_copy[col] = df_copy[col].astype('boolean') # Use pandas nullable boolean
+            df[col] = df[col].astype('boolean') # Use pandas nullable boolean
 
     # --- Process Object Columns (most complex) ---
     # These may contain lists, dicts, or mixed types. We serialize them to JSON strings.
-    obj_cols = df_copy.select_dtypes(include=['object']).columns
-    if not obj_cols.empty:
-        logging.info(f"Serializing object columns: {list(obj_cols)}")
+    obj_cols = cols_by_kind['O']
+    if obj_cols:
+        logging.info(f"Serializing object columns: {obj_cols}")
         for col in obj_cols:
-            # .apply is necessary here due to the heterogeneous nature of object columns
-            df_copy[col] = df_copy[col].apply(_serialize_object)
+            # Pure string columns (most Power BI scalar fields) are already Spark-ready
+            if pd.api.types.infer_dtype(df[col], skipna=True) == 'string':
+                continue
+            df[col] = _serialize_object_column(df[col])
 
     # All columns are now either a primitive type (int, float, bool, datetime) or a string.
     # Spark's `createDataFrame` can handle this schema efficiently.
-    return df_copy
+    return df
 
-def save_to_fabric_warehouse(
-    pandas_dfs: dict[str, pd.DataFrame],
-    warehouse_schema: str,
-    spark: SparkSession
-):
-    """Saves a dictionary of Pandas DataFrames to specified tables in a Fabric Warehouse."""
-    for table_name, df_pandas in pandas_dfs.items():
-        logging.info(f"Processing table '{table_name}'...")
-        
-        # if df_pandas.empty:
-            # logging.warning(f"DataFrame for table '{table_name}' is empty. Skipping.")
-            # continue
+def records_to_arrow_table(records: list[dict], schema: pa.Schema, json_fields: tuple = ()) -> pa.Table:
+    """
+    Builds an Arrow Table straight from API records with a fixed schema, bypassing pandas and the cast pipeline.
+    Keys missing from `schema` are dropped and missing values become nulls, so column types don't drift between runs.
+    Fields listed in `json_fields` (declared as pa.string()) hold nested lists/dicts and are JSON-encoded;
+    struct fields are flattened into '<field>_<child>' columns.
+    """
+    # from_pylist converts the scalar fields in C; only the nested fields need a Python pass
+    scalar_schema = pa.schema([field for field in schema if field.name not in json_fields])
+    table = pa.Table.from_pylist(records, schema=scalar_schema)
+    for name in json_fields:
+        encoded = pa.array([_serialize_object(record.get(name)) for record in records], type=pa.string())
+        table = table.append_column(schema.field(name), encoded)
+    table = table.select(schema.names).flatten()
+    return table.rename_columns([clean_column_name(name) for name in table.column_names])
 
-        try:
+def spark_supports_arrow_tables(spark: SparkSession) -> bool:
+    """Returns True when `spark.createDataFrame` accepts an Arrow Table directly (Spark 4.0+)."""
+    return int(spark.version.split('.')[0]) >= 4
+
+def _arrow_table_to_spark(spark: SparkSession, table: pa.Table):
+    """Converts an Arrow Table to a Spark DataFrame, keeping the Table's column types."""
+    if spark_supports_arrow_tables(spark):
+        return spark.createDataFrame(table)
+    # Older Spark only takes pandas; pass the schema so nullable columns keep their Arrow types
+    return spark.createDataFrame(table.to_pandas(), schema=from_arrow_schema(table.schema))
+
+def _save_table(spark: SparkSession, table_name: str, df_pandas, warehouse_schema: str):
+    """Converts one table to a Spark DataFrame and overwrites it in the Fabric Warehouse."""
+    logging.info(f"Processing table '{table_name}'...")
+    # Scheduler pools are per-thread; put each concurrent write in the fair pool so jobs share executors
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", "fair")
+
+    # if df_pandas.empty:
+        # logging.warning(f"DataFrame for table '{table_name}' is empty. Skipping.")
+        # return
+
+    try:
+        if isinstance(df_pandas, pa.Table):
+            # Arrow Tables already carry their declared schema; convert directly
+            if df_pandas.num_rows == 0:
+                logging.warning(f"Table '{table_name}' has 0 rows. Skipping save operation.")
+                return
+            spark_df = _arrow_table_to_spark(spark, df_pandas)
+            row_count = df_pandas.num_rows
+        else:
             # 1. Cast Pandas DataFrame to compatible types
             df_casted = cast_dataframe_to_fabric_compatible_types(df_pandas)
             if df_casted.shape[0] == 0:
                 logging.warning(f"DataFrame for table '{table_name}' has 0 rows after processing. Skipping save operation.")
-                continue
-            
+                return
+
             # 2. Convert to Spark DataFrame (Spark will infer the schema)
-            # Enable Arrow for faster conversion
-            spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
             spark_df = spark.createDataFrame(df_casted)
-            logging.info(f"'{table_name}' converted to Spark DataFrame with {spark_df.count()} rows.")
-
-            # 3. Save to Fabric Warehouse
-            full_table_name = f"{warehouse_schema}.{table_name}"
-            spark.sql(f"CREATE SCHEMA IF NOT EXISTS {warehouse_schema}")
-            
-            spark_df.write.format("delta").mode("overwrite").saveAsTable(full_table_name)
-            logging.info(f"✅ Successfully saved data to Fabric table: {full_table_name}")
-
-        except Exception as e:
-            logging.error(f"❌ Error processing table '{table_name}': {e}", exc_info=True)
-            raise
\ No newline at end of file
+            row_count = len(df_casted)
+        # Row count comes from the source side; spark_df.count() would scan the whole dataset just to log it
+        logging.info(f"'{table_name}' converted to Spark DataFrame with {row_count} rows.")
+
+        # 3. Save to Fabric Warehouse
+        full_table_name = f"{warehouse_schema}.{table_name}"
+        spark_df.write.format("delta").mode("overwrite").saveAsTable(full_table_name)
+        logging.info(f"✅ Successfully saved data to Fabric table: {full_table_name}")
+
+    except Exception as e:
+        logging.error(f"❌ Error processing table '{table_name}': {e}", exc_info=True)
+        raise
+
+def save_to_fabric_warehouse(
+    pandas_dfs: dict[str, pd.DataFrame | pa.Table],
+    warehouse_schema: str,
+    spark: SparkSession,
+    max_workers: int = 4
+):
+    """
+    Saves a dictionary of Pandas DataFrames to specified tables in a Fabric Warehouse.
+    Values may also be Arrow Tables (see `records_to_arrow_table`), which skip the pandas casting step.
+    Up to `max_workers` tables are written concurrently so their Spark jobs overlap.
+    """
+    # Enable Arrow for faster pandas -> Spark conversion. Set once for the session rather than per table;
+    # fallback keeps unsupported schemas working (row-based) instead of failing the write.
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+    spark.conf.set("spark.sql.execution.arrow.pyspark.fallback.enabled", "true")
+    spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", "20000")
+    # Create the schema up front so concurrent writers don't race on it
+    spark.sql(f"CREATE SCHEMA IF NOT EXISTS {warehouse_schema}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_save_table, spark, table_name, df_pandas, warehouse_schema): table_name
+            for table_name, df_pandas in pandas_dfs.items()
+        }
+        for future in as_completed(futures):
+            future.result() # Re-raises the first failed table's error (already logged in _save_table)
\ No newline at end of file
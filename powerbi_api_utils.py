@@ -5,9 +5,18 @@ import json
 import time
 import os
 import logging
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import httpx # Use httpx for async requests
 import asyncio
 
+try:
+    import h2 # noqa: F401 -- httpx only negotiates HTTP/2 when the 'h2' package is present
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -65,48 +74,117 @@ def get_access_token(client_id, client_secret, authority, scope):
         raise
 
 # --- Asynchronous Power BI API Data Fetching ---
+def create_async_client(access_token: str, verify_ssl: bool = True, timeout: float = 45.0, max_connections: int = 64) -> httpx.AsyncClient:
+    """
+    Creates the AsyncClient shared by all Power BI API calls. The auth header is set once on the
+    client, connections are pooled and kept alive, and HTTP/2 multiplexes requests over a single
+    connection when the 'h2' package is installed (`pip install "httpx[http2]"`).
+    """
+    if not HTTP2_AVAILABLE:
+        logging.warning("The 'h2' package is not installed; Power BI requests will use HTTP/1.1. Install httpx[http2] to enable HTTP/2.")
+    return httpx.AsyncClient(
+        headers={'Authorization': f'Bearer {access_token}'},
+        verify=verify_ssl,
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(timeout, connect=10.0),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections // 2),
+    )
+
+RETRYABLE_STATUS_CODES = (408, 429, 502, 503, 504)
+
+def _get_retry_after_seconds(response: httpx.Response):
+    """
+    Returns how long the service asked us to wait before retrying, or None if it didn't say.
+    Power BI sends either 'x-ms-retry-after-ms' (milliseconds) or the standard 'Retry-After'
+    (seconds or an HTTP date).
+    """
+    retry_after_ms = response.headers.get("x-ms-retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000.0)
+        except ValueError:
+            pass
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                return None
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    return None
+
 # FIX: Increased max_retries and backoff_factor to better handle throttling (HTTP 429)
-async def get_paginated_data_async(client: httpx.AsyncClient, url: str, headers: dict, params: dict = None, max_retries: int = 5, backoff_factor: float = 2.0):
+async def get_paginated_data_async(client: httpx.AsyncClient, url: str, params: dict = None, max_retries: int = 5, backoff_factor: float = 2.0, max_backoff: float = 60.0, expected_status_codes: tuple = ()):
     """
     Asynchronously fetches data from Power BI API endpoints that support pagination,
     with more robust retries for throttling.
+    `client` should come from `create_async_client`, which carries the auth header and timeouts.
+    Retries wait for the service's Retry-After hint when given, otherwise use decorrelated
+    jitter (starting at `backoff_factor`, capped at `max_backoff`) so concurrent callers
+    don't retry in lockstep.
+    Errors with a status in `expected_status_codes` are raised without being logged, for callers
+    that handle them (e.g. skip forbidden items) and log them their own way.
     """
     all_data = []
     next_page_url = url
+    prev_sleep = backoff_factor
     
     while next_page_url:
+        current_params = params if next_page_url == url else None
+        # Each attempt either succeeds (break) or raises; a page is never silently skipped
         for attempt in range(max_retries):
             try:
-                current_params = params if next_page_url == url else None
-                response = await client.get(next_page_url, headers=headers, params=current_params, timeout=45.0)
+                response = await client.get(next_page_url, params=current_params)
                 response.raise_for_status()
-                data = response.json()
-                
-                value = data.get('value', [])
-                if isinstance(value, list):
-                    all_data.extend(value)
-                else:
-                    all_data.append(value)
-                    next_page_url = None
-                    break
-
-                next_page_url = data.get('@odata.nextLink')
                 break
-
             except httpx.HTTPStatusError as e:
-                # Retry on rate limiting (429) or common server errors (5xx)
-                if e.response.status_code in [429, 502, 503, 504] and attempt < max_retries - 1:
-                    sleep_time = backoff_factor * (2 ** attempt)
-                    logging.warning(f"HTTP error {e.response.status_code} on {url}. Retrying in {sleep_time:.2f}s...")
-                    await asyncio.sleep(sleep_time)
-                else:
-                    logging.error(f"HTTP error fetching {url}: {e.response.status_code} - {e.response.text}")
+                status_code = e.response.status_code
+                # Retry on timeouts (408), rate limiting (429) or common server errors (5xx)
+                if status_code not in RETRYABLE_STATUS_CODES:
+                    if status_code not in expected_status_codes:
+                        logging.error(f"HTTP error fetching {url}: {status_code} - {e.response.text}")
+                    raise
+                if attempt == max_retries - 1:
+                    logging.error(f"Max retries exceeded for {url}: {status_code} - {e.response.text}")
                     raise
+                sleep_time = _get_retry_after_seconds(e.response)
+                if sleep_time is None:
+                    sleep_time = min(max_backoff, random.uniform(backoff_factor, prev_sleep * 3))
+                prev_sleep = max(backoff_factor, sleep_time)
+                logging.warning(f"HTTP error {status_code} on {url}. Retrying in {sleep_time:.2f}s...")
+                await asyncio.sleep(sleep_time)
             except Exception as e:
                 logging.error(f"An unexpected error occurred fetching {url}: {e}")
                 raise
+
+        data = response.json()
+        value = data.get('value', [])
+        if isinstance(value, list):
+            all_data.extend(value)
+            next_page_url = data.get('@odata.nextLink')
         else:
-             logging.error(f"Max retries exceeded for {url}.")
-             break
+            all_data.append(value)
+            next_page_url = None
+
+    return all_data
 
-    return all_data
\ No newline at end of file
+async def get_paginated_admin_groups_async(client: httpx.AsyncClient, url: str, params: dict = None, page_size: int = 5000, **retry_options):
+    """
+    Asynchronously fetches all workspaces from the admin groups endpoint, which requires `$top` and
+    pages with `$skip` rather than '@odata.nextLink'. Pages are requested until a short page comes back.
+    """
+    all_groups = []
+    skip = 0
+    while True:
+        page_params = {**(params or {}), '$top': page_size, '$skip': skip}
+        page = await get_paginated_data_async(client, url, params=page_params, **retry_options)
+        all_groups.extend(page)
+        logging.info(f"Fetched {len(page)} workspaces (skip={skip}) from {url}.")
+        if len(page) < page_size:
+            return all_groups
+        skip += page_size
\ No newline at end of file
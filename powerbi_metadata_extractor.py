@@ -1,174 +1,268 @@
 import pandas as pd
+import pyarrow as pa
 import json
 import logging
+import asyncio
+import httpx
 
 # Ensure these imports are correct and match your file names
-from powerbi_api_utils import load_config, get_api_constants, get_access_token, get_paginated_data, get_paginated_admin_groups
-from fabric_utils import save_to_fabric_warehouse # get_or_create_spark_session is removed
+from powerbi_api_utils import load_config, get_api_constants, get_access_token, create_async_client, get_paginated_data_async, get_paginated_admin_groups_async
+from fabric_utils import save_to_fabric_warehouse, records_to_arrow_table, spark_supports_arrow_tables, clean_columns # get_or_create_spark_session is removed
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_all_metadata(token, base_url, admin_base_url, verify_ssl, include_report_app_users=True):
-    """Orchestrates the fetching of all Power BI metadata."""
+# Per-item endpoints answer 403/404 for items the caller can't see (e.g. a personal gateway datasource);
+# those items are skipped. Anything else (throttling after all retries, auth, 5xx, network) fails the run
+# so a partial extraction never overwrites the warehouse tables.
+SKIPPABLE_ITEM_STATUS_CODES = (403, 404)
+
+# Declared schemas for the largest tables, which are built as Arrow Tables when Spark accepts them.
+# Declaring the types keeps them stable from run to run (an all-null or mixed column can't change type).
+# 'profile' is flattened into profile_* columns; fields in REPORT_JSON_FIELDS are stored as JSON strings.
+USER_PROFILE_TYPE = pa.struct([('id', pa.string()), ('displayName', pa.string())])
+WORKSPACE_USERS_SCHEMA = pa.schema([
+    ('identifier', pa.string()),
+    ('displayName', pa.string()),
+    ('emailAddress', pa.string()),
+    ('groupUserAccessRight', pa.string()),
+    ('principalType', pa.string()),
+    ('graphId', pa.string()),
+    ('userType', pa.string()),
+    ('profile', USER_PROFILE_TYPE),
+    ('workspace_id', pa.string()),
+    ('workspace_name', pa.string()),
+])
+REPORT_JSON_FIELDS = ('endorsementDetails', 'sensitivityLabel', 'users', 'subscriptions')
+REPORTS_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('reportType', pa.string()),
+    ('name', pa.string()),
+    ('description', pa.string()),
+    ('webUrl', pa.string()),
+    ('embedUrl', pa.string()),
+    ('datasetId', pa.string()),
+    ('appId', pa.string()),
+    ('originalReportObjectId', pa.string()),
+    ('isOwnedByMe', pa.bool_()),
+    ('createdDateTime', pa.string()),
+    ('modifiedDateTime', pa.string()),
+    ('createdBy', pa.string()),
+    ('modifiedBy', pa.string()),
+    ('endorsementDetails', pa.string()),
+    ('sensitivityLabel', pa.string()),
+    ('users', pa.string()),
+    ('subscriptions', pa.string()),
+    ('workspace_id', pa.string()),
+    ('workspace_name', pa.string()),
+])
+REPORT_USERS_SCHEMA = pa.schema([
+    ('identifier', pa.string()),
+    ('displayName', pa.string()),
+    ('emailAddress', pa.string()),
+    ('reportUserAccessRight', pa.string()),
+    ('principalType', pa.string()),
+    ('graphId', pa.string()),
+    ('userType', pa.string()),
+    ('profile', USER_PROFILE_TYPE),
+    ('report_id', pa.string()),
+    ('report_name', pa.string()),
+    ('workspace_id', pa.string()),
+])
+
+async def _fetch_all_bounded(client, sem, urls, params=None):
+    """
+    Fetches every URL concurrently, never running more than the semaphore allows at once.
+    Results come back in the same order as `urls`. Items answering 403/404 are logged, counted and
+    yield an empty list; any other failure cancels the remaining fetches and is re-raised right away.
+    """
+    async def _fetch_one(url):
+        async with sem:
+            try:
+                return await get_paginated_data_async(
+                    client, url, params=params, expected_status_codes=SKIPPABLE_ITEM_STATUS_CODES
+                )
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in SKIPPABLE_ITEM_STATUS_CODES:
+                    raise
+                logging.warning(f"Skipping {url}: HTTP {e.response.status_code}")
+                return None
+
+    tasks = [asyncio.ensure_future(_fetch_one(url)) for url in urls]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # Fail fast: cancel the fetches still queued or in flight instead of waiting for all of them
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    skipped = sum(result is None for result in results)
+    if skipped:
+        logging.warning(f"Skipped {skipped} of {len(urls)} requests that returned {SKIPPABLE_ITEM_STATUS_CODES}.")
+    return [[] if result is None else result for result in results]
+
+def _expand_dict_column(df: pd.DataFrame, col: str) -> pd.DataFrame:
+    """
+    Replaces a column of dicts with '<col>_<field>' columns. Only that column is normalized, and the
+    new columns are assigned onto the frame instead of rebuilding it with drop + concat.
+    """
+    # Power BI details/profile objects are flat, so one level with sep='_' yields final column names
+    expanded = pd.json_normalize(df.pop(col), sep='_', max_level=1).add_prefix(f'{col}_')
+    expanded.index = df.index
+    for name, values in expanded.items():
+        df[name] = values
+    return df
+
+async def get_all_metadata_async(client, base_url, admin_base_url, include_report_app_users=True, max_concurrency=32, use_arrow=False):
+    """
+    Orchestrates the fetching of all Power BI metadata, fanning out per-item requests concurrently.
+    `client` is the shared client from `create_async_client`.
+    With `use_arrow`, workspace_users, reports and report_users are returned as Arrow Tables with
+    declared schemas; only pass it when Spark can take Arrow Tables (see `spark_supports_arrow_tables`).
+    """
+    sem = asyncio.Semaphore(max_concurrency)
     print("\n--- Fetching Tenant-Level Admin Data ---")
     print("\nFetching Capacities...")
     capacities_url = f"{admin_base_url}/capacities"
-    capacities_data = get_paginated_data(token, capacities_url, verify_ssl)
+    capacities_data = await get_paginated_data_async(client, capacities_url)
     capacities_df = pd.DataFrame(capacities_data)
     if not capacities_df.empty:
         capacities_df['admins'] = capacities_df['admins'].apply(
             lambda x: ', '.join(x) if isinstance(x, list) else (x if x is not None else None)
         )
-        capacities_df.columns = [col.replace('.', '_').replace(' ', '_') for col in capacities_df.columns]
+        clean_columns(capacities_df)
     print("\n--- Fetching Gateways (User/Shared Scope) and their Data Sources and Users ---")
     gateways_url = f"{base_url}/gateways"
-    gateways_data = get_paginated_data(token=token, url=gateways_url, verify_ssl=verify_ssl)
+    gateways_data = await get_paginated_data_async(client, gateways_url)
     processed_gateways = []
     all_gateway_datasources = []
     all_datasource_users = []
-    if gateways_data:
-        for gateway in gateways_data:
-            gateway_id = gateway.get('id')
-            filtered_gateway = {k: v for k, v in gateway.items() if k not in ['publicKey', 'gatewayAnnotation']}
-            processed_gateways.append(filtered_gateway)
-            if gateway_id:
-                print(f"  - Fetching datasources for Gateway ID: {gateway_id}")
-                datasources_url = f"{base_url}/gateways/{gateway_id}/datasources"
-                datasources_data = get_paginated_data(token=token, url=datasources_url, verify_ssl=verify_ssl)
-                for ds in datasources_data:
-                    datasource_id = ds.get('id')
-                    ds['gatewayId'] = gateway_id
-                    if 'credentialDetails' in ds and isinstance(ds['credentialDetails'], dict):
-                        credential_details = ds.pop('credentialDetails')
-                        for k, v in credential_details.items():
-                            ds[f'credentialDetails_{k}'] = v
-                    all_gateway_datasources.append(ds)
-                    if datasource_id:
-                        print(f"    - Fetching users for Datasource ID: {datasource_id} (Gateway: {gateway_id})")
-                        datasource_users_url = f"{base_url}/gateways/{gateway_id}/datasources/{datasource_id}/users"
-                        users_data = get_paginated_data(token=token, url=datasource_users_url, verify_ssl=verify_ssl)
-                        for user in users_data:
-                            user['gatewayId'] = gateway_id
-                            user['datasourceId'] = datasource_id
-                            all_datasource_users.append(user)
+    gateway_ids = []
+    for gateway in gateways_data:
+        processed_gateways.append({k: v for k, v in gateway.items() if k not in ['publicKey', 'gatewayAnnotation']})
+        if gateway.get('id'):
+            gateway_ids.append(gateway['id'])
+    print(f"  - Fetching datasources for {len(gateway_ids)} gateways")
+    datasources_results = await _fetch_all_bounded(
+        client, sem, [f"{base_url}/gateways/{gateway_id}/datasources" for gateway_id in gateway_ids]
+    )
+    datasource_keys = []
+    for gateway_id, datasources_data in zip(gateway_ids, datasources_results):
+        for ds in datasources_data:
+            # Build an enriched copy rather than mutating the API record in place
+            record = {**ds, 'gatewayId': gateway_id}
+            if isinstance(record.get('credentialDetails'), dict):
+                record.update({f'credentialDetails_{k}': v for k, v in record.pop('credentialDetails').items()})
+            all_gateway_datasources.append(record)
+        datasource_keys.extend((gateway_id, ds['id']) for ds in datasources_data if ds.get('id'))
+    print(f"    - Fetching users for {len(datasource_keys)} gateway datasources")
+    datasource_users_results = await _fetch_all_bounded(
+        client, sem,
+        [f"{base_url}/gateways/{gateway_id}/datasources/{datasource_id}/users" for gateway_id, datasource_id in datasource_keys]
+    )
+    for (gateway_id, datasource_id), users_data in zip(datasource_keys, datasource_users_results):
+        all_datasource_users.extend({**user, 'gatewayId': gateway_id, 'datasourceId': datasource_id} for user in users_data)
     gateways_df = pd.DataFrame(processed_gateways)
-    if not gateways_df.empty:
-        gateways_df.columns = [col.replace('.', '_').replace(' ', '_') for col in gateways_df.columns]
+    clean_columns(gateways_df)
     gateway_datasources_df = pd.DataFrame(all_gateway_datasources)
     if not gateway_datasources_df.empty:
-        gateway_datasources_df.columns = [col.replace('.', '_').replace(' ', '_') for col in gateway_datasources_df.columns]
+        clean_columns(gateway_datasources_df)
         if 'details' in gateway_datasources_df.columns:
-            details_df = pd.json_normalize(gateway_datasources_df['details'])
-            details_df.columns = [f"details_{col.replace('.', '_').replace(' ', '_')}" for col in details_df.columns]
-            gateway_datasources_df = pd.concat([gateway_datasources_df.drop(columns=['details']), details_df], axis=1)
+            _expand_dict_column(gateway_datasources_df, 'details')
     gateway_datasource_users_df = pd.DataFrame(all_datasource_users)
-    if not gateway_datasource_users_df.empty:
-        gateway_datasource_users_df.columns = [col.replace('.', '_').replace(' ', '_') for col in gateway_datasource_users_df.columns]
+    clean_columns(gateway_datasource_users_df)
     print("\n--- Fetching Workspace-Level Data ---")
     workspaces_base_url = f"{admin_base_url}/groups"
-    expand_payload = "users,reports,datasets,dataflows"
-    workspace_filter = "type eq 'Workspace' and state eq 'Active'"
-    workspaces_data = get_paginated_admin_groups(
-        token,
-        workspaces_base_url,
-        expand_payload,
-        verify_ssl,
-        filter_str=workspace_filter
-    )
+    workspaces_params = {
+        "$expand": "users,reports,datasets,dataflows",
+        "$filter": "type eq 'Workspace' and state eq 'Active'",
+    }
+    workspaces_data = await get_paginated_admin_groups_async(client, workspaces_base_url, params=workspaces_params)
     all_workspaces, all_workspace_users, all_reports, all_datasets, all_dataflows = [], [], [], [], []
     for ws in workspaces_data:
         ws_id = ws['id']
         ws_name = ws['name']
         print(f"\nProcessing Workspace: '{ws_name}' ({ws_id})")
         all_workspaces.append({k: ws.get(k) for k in ['id', 'name', 'isOnDedicatedCapacity', 'capacityId', 'type', 'state']})
-        for user in ws.get('users', []):
-            user.update({'workspace_id': ws_id, 'workspace_name': ws_name})
-            all_workspace_users.append(user)
-        for report in ws.get('reports', []):
-            report.update({'workspace_id': ws_id, 'workspace_name': ws_name})
-            all_reports.append(report)
-        for dataset in ws.get('datasets', []):
-            dataset.update({'workspace_id': ws_id, 'workspace_name': ws_name})
-            all_datasets.append(dataset)
-        for dataflow in ws.get('dataflows', []):
-            dataflow.update({'workspace_id': ws_id, 'workspace_name': ws_name})
-            all_dataflows.append(dataflow)
+        # Build enriched copies rather than mutating the API records in place
+        all_workspace_users.extend({**user, 'workspace_id': ws_id, 'workspace_name': ws_name} for user in ws.get('users', ()))
+        all_reports.extend({**report, 'workspace_id': ws_id, 'workspace_name': ws_name} for report in ws.get('reports', ()))
+        all_datasets.extend({**dataset, 'workspace_id': ws_id, 'workspace_name': ws_name} for dataset in ws.get('datasets', ()))
+        all_dataflows.extend({**dataflow, 'workspace_id': ws_id, 'workspace_name': ws_name} for dataflow in ws.get('dataflows', ()))
     workspaces_df = pd.DataFrame(all_workspaces)
-    if not workspaces_df.empty:
-        workspaces_df.columns = [col.replace('.', '_').replace(' ', '_') for col in workspaces_df.columns]
-    workspace_users_df = pd.DataFrame(all_workspace_users)
-    if not workspace_users_df.empty:
-        workspace_users_df.columns = [col.replace('.', '_').replace(' ', '_') for col in workspace_users_df.columns]
-        if 'profile' in workspace_users_df.columns:
-            profile_df = pd.json_normalize(workspace_users_df['profile']).add_prefix('profile_')
-            profile_df.columns = [col.replace('.', '_').replace(' ', '_') for col in profile_df.columns]
-            workspace_users_df = pd.concat([workspace_users_df.drop(columns=['profile']), profile_df], axis=1)
-    reports_df = pd.DataFrame(all_reports)
-    if not reports_df.empty:
-        reports_df.columns = [col.replace('.', '_').replace(' ', '_') for col in reports_df.columns]
+    clean_columns(workspaces_df)
+    if use_arrow:
+        # The largest collections go straight to Arrow, skipping pandas and the object-column casting
+        workspace_users_df = records_to_arrow_table(all_workspace_users, WORKSPACE_USERS_SCHEMA)
+        reports_df = records_to_arrow_table(all_reports, REPORTS_SCHEMA, json_fields=REPORT_JSON_FIELDS)
+    else:
+        workspace_users_df = pd.DataFrame(all_workspace_users)
+        if not workspace_users_df.empty:
+            clean_columns(workspace_users_df)
+            if 'profile' in workspace_users_df.columns:
+                _expand_dict_column(workspace_users_df, 'profile')
+        reports_df = pd.DataFrame(all_reports)
+        clean_columns(reports_df)
     datasets_df = pd.DataFrame(all_datasets)
     if not datasets_df.empty:
-        datasets_df.columns = [col.replace('.', '_').replace(' ', '_') for col in datasets_df.columns]
+        clean_columns(datasets_df)
         for col in ['qnaQuestions', 'queryMetrics']:
             if col in datasets_df.columns:
                 datasets_df[col] = datasets_df[col].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
     dataflows_df = pd.DataFrame(all_dataflows)
-    if not dataflows_df.empty:
-        dataflows_df.columns = [col.replace('.', '_').replace(' ', '_') for col in dataflows_df.columns]
+    clean_columns(dataflows_df)
     all_apps = []
     all_app_users = []
     if include_report_app_users:
         print("\n--- Fetching Apps and App Users ---")
         apps_url = f"{admin_base_url}/apps"
-        apps_data = get_paginated_data(token, apps_url, verify_ssl, params={'$top': 5000})
-        for app in apps_data:
-            app_id = app['id']
-            app_name = app['name']
-            print(f"    - Processing App: '{app_name}' ({app_id})")
-            all_apps.append(app)
-            print(f"        - Fetching users for App ID: {app_id}")
-            app_users_url = f"{admin_base_url}/apps/{app_id}/users"
-            app_users_data = get_paginated_data(token, app_users_url, verify_ssl)
-            for user in app_users_data:
-                user.update({'app_id': app_id, 'app_name': app_name})
-                all_app_users.append(user)
+        apps_data = await get_paginated_data_async(client, apps_url, params={'$top': 5000})
+        all_apps.extend(apps_data)
+        print(f"        - Fetching users for {len(apps_data)} apps")
+        app_users_results = await _fetch_all_bounded(
+            client, sem, [f"{admin_base_url}/apps/{app['id']}/users" for app in apps_data]
+        )
+        for app, app_users_data in zip(apps_data, app_users_results):
+            all_app_users.extend({**user, 'app_id': app['id'], 'app_name': app['name']} for user in app_users_data)
     else:
         print("\n--- Skipping Apps and App Users fetch as per user's choice ---")
     apps_df = pd.DataFrame(all_apps)
     if not apps_df.empty:
-        apps_df.columns = [col.replace('.', '_').replace(' ', '_') for col in apps_df.columns]
+        clean_columns(apps_df)
         if 'lastUpdateDateTime' in apps_df.columns:
-            apps_df['lastUpdateDateTime'] = pd.to_datetime(apps_df['lastUpdateDateTime'], errors='coerce')
+            # Power BI returns strict ISO-8601 UTC timestamps; an explicit format avoids per-row format inference
+            apps_df['lastUpdateDateTime'] = pd.to_datetime(apps_df['lastUpdateDateTime'], format='ISO8601', errors='coerce', utc=True)
     app_users_df = pd.DataFrame(all_app_users)
     if not app_users_df.empty:
-        app_users_df.columns = [col.replace('.', '_').replace(' ', '_') for col in app_users_df.columns]
+        clean_columns(app_users_df)
         if 'profile' in app_users_df.columns:
-            profile_df = pd.json_normalize(app_users_df['profile']).add_prefix('profile_')
-            profile_df.columns = [col.replace('.', '_').replace(' ', '_') for col in profile_df.columns]
-            app_users_df = pd.concat([app_users_df.drop(columns=['profile']), profile_df], axis=1)
+            _expand_dict_column(app_users_df, 'profile')
     all_report_users = []
     if include_report_app_users:
         print("\n--- Fetching Report-Level User Access (this may take a long time) ---")
-        if not reports_df.empty:
-            for index, report in reports_df.iterrows():
-                report_id = report['id']
-                report_name = report['name']
-                ws_id = report['workspace_id']
-                print(f"    - Fetching users for Report: '{report_name}' in Workspace ID: {ws_id}")
-                report_users_url = f"{admin_base_url}/groups/{ws_id}/reports/{report_id}/users"
-                report_users_data = get_paginated_data(token, report_users_url, verify_ssl)
-                for user in report_users_data:
-                    user.update({'report_id': report_id, 'report_name': report_name, 'workspace_id': ws_id})
-                    all_report_users.append(user)
+        if all_reports:
+            # Iterate the raw records rather than reports_df rows to avoid boxing each row into a Series
+            report_keys = [(report['id'], report['name'], report['workspace_id']) for report in all_reports]
+            print(f"    - Fetching users for {len(report_keys)} reports")
+            report_users_results = await _fetch_all_bounded(
+                client, sem,
+                [f"{admin_base_url}/groups/{ws_id}/reports/{report_id}/users" for report_id, report_name, ws_id in report_keys]
+            )
+            for (report_id, report_name, ws_id), report_users_data in zip(report_keys, report_users_results):
+                all_report_users.extend(
+                    {**user, 'report_id': report_id, 'report_name': report_name, 'workspace_id': ws_id}
+                    for user in report_users_data
+                )
     else:
         print("\n--- Skipping Report-Level User Access fetch as per user's choice ---")
-    report_users_df = pd.DataFrame(all_report_users)
-    if not report_users_df.empty:
-        report_users_df.columns = [col.replace('.', '_').replace(' ', '_') for col in report_users_df.columns]
-        if 'profile' in report_users_df.columns:
-            profile_df = pd.json_normalize(report_users_df['profile']).add_prefix('profile_')
-            profile_df.columns = [col.replace('.', '_').replace(' ', '_') for col in profile_df.columns]
-            report_users_df = pd.concat([report_users_df.drop(columns=['profile']), profile_df], axis=1)
+    if use_arrow:
+        report_users_df = records_to_arrow_table(all_report_users, REPORT_USERS_SCHEMA)
+    else:
+        report_users_df = pd.DataFrame(all_report_users)
+        if not report_users_df.empty:
+            clean_columns(report_users_df)
+            if 'profile' in report_users_df.columns:
+                _expand_dict_column(report_users_df, 'profile')
     return {
         "capacities": capacities_df,
         "gateways": gateways_df,
@@ -185,10 +279,11 @@ def get_all_metadata(token, base_url, admin_base_url, verify_ssl, include_report
     }
 
 
-def run_extraction_to_fabric():
+async def run_extraction_to_fabric():
     """
-    Main function to run the metadata extraction and save to Fabric Warehouse process.
-    Designed for execution within a Microsoft Fabric notebook.
+    Main async function to run the metadata extraction and save to Fabric Warehouse process.
+    Designed for execution within a Microsoft Fabric notebook, where the kernel already runs an
+    event loop: call it with `await run_extraction_to_fabric()`.
     """
     try:
         # Get Spark session directly from the global scope (where print(spark) works)
@@ -225,17 +320,20 @@ def run_extraction_to_fabric():
                 print("Invalid input. Please enter 'yes' or 'no'.")
 
         print("7. Starting metadata extraction...")
-        all_data_pandas_dfs = get_all_metadata(
-            access_token,
-            BASE_URL,
-            ADMIN_BASE_URL,
-            config["VERIFY_SSL"],
-            include_report_app_users=include_users
-        )
+        # One client for the whole run so every request reuses its pooled (HTTP/2) connections
+        async with create_async_client(access_token, config["VERIFY_SSL"]) as client:
+            all_data_pandas_dfs = await get_all_metadata_async(
+                client,
+                BASE_URL,
+                ADMIN_BASE_URL,
+                include_report_app_users=include_users,
+                # Spark 4.0+ takes Arrow Tables directly; older runtimes convert via pandas, so stay on pandas there
+                use_arrow=spark_supports_arrow_tables(spark_session)
+            )
         
         print("\n8. Saving extracted metadata to Microsoft Fabric Warehouse...")
         # Pass the obtained spark_session directly to save_to_fabric_warehouse
-        save_to_fabric_warehouse(all_data_pandas_dfs, warehouse_schema="powerbi_metadata", spark_session=spark_session)
+        save_to_fabric_warehouse(all_data_pandas_dfs, warehouse_schema="powerbi_metadata", spark=spark_session)
         print("9. Metadata extraction and saving to Fabric Warehouse completed.")
 
     except Exception as e: